@@ -11,7 +11,7 @@ Features:
 - Basic anti-abuse: admin-only actions, rate-limited broadcast, validation of inputs
 
 Dependencies:
-  pip install aiogram aiosqlite
+  pip install aiogram aiosqlite aiolimiter
 
 How to configure:
   1) Create config.json next to this file with the following content:
@@ -19,6 +19,18 @@ How to configure:
        "BOT_TOKEN": "<your-bot-token>",
        "ADMIN_ID": 123456789
      }
+     To receive updates via webhook instead of long polling, also add
+       "WEBHOOK_HOST": "https://your.domain",
+       "WEBHOOK_PATH": "/tg/<random>",   (optional, default is derived from the bot token)
+       "WEBHOOK_SECRET": "<random>",     (optional, default is generated on every start)
+       "WEBAPP_HOST": "0.0.0.0",         (optional, default "0.0.0.0")
+       "WEBAPP_PORT": 8443               (optional, default 8443)
+     Telegram delivers webhooks over HTTPS only: either put the bot behind a
+     TLS-terminating reverse proxy, or add
+       "WEBHOOK_SSL_CERT": "/path/to/fullchain.pem",
+       "WEBHOOK_SSL_PRIV": "/path/to/privkey.pem"
+     so the bot serves HTTPS itself. Requests are authenticated by the secret token;
+     when serving HTTPS directly the sender IP is also checked against Telegram's networks.
   2) Run: python tg_school_bot.py
 
 Manager username is set by MANAGER_USERNAME constant in code (default: "qwuzinw").
@@ -26,17 +38,32 @@ Manager username is set by MANAGER_USERNAME constant in code (default: "qwuzinw"
 """
 
 import asyncio
+import hashlib
+import hmac
 import json
 import logging
-import sqlite3
+import os
+import secrets
+import ssl
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Dict
+from typing import AsyncIterator, Dict, List, Tuple
+
+import aiosqlite
+from aiohttp import web
+from aiolimiter import AsyncLimiter
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils import executor
+from aiogram.utils.exceptions import (
+    ChatNotFound, MessageNotModified, NetworkError, RetryAfter, TelegramAPIError, Unauthorized,
+)
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.filters import Text
 from aiogram.dispatcher.filters.state import State, StatesGroup
 
 # ----------------- CONFIG -----------------
@@ -49,6 +76,17 @@ with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
     cfg = json.load(f)
 BOT_TOKEN = cfg['BOT_TOKEN']
 ADMIN_ID = int(cfg['ADMIN_ID'])
+# webhook mode is used when WEBHOOK_HOST is set, long polling otherwise
+WEBHOOK_HOST = cfg.get('WEBHOOK_HOST', '').rstrip('/')
+# non-guessable by default, stable across restarts
+WEBHOOK_PATH = cfg.get('WEBHOOK_PATH') or '/tg/' + hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+WEBHOOK_URL = f'{WEBHOOK_HOST}{WEBHOOK_PATH}'
+# sent back by Telegram in X-Telegram-Bot-Api-Secret-Token with every update
+WEBHOOK_SECRET = cfg.get('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+WEBHOOK_SSL_CERT = cfg.get('WEBHOOK_SSL_CERT', '')
+WEBHOOK_SSL_PRIV = cfg.get('WEBHOOK_SSL_PRIV', '')
+WEBAPP_HOST = cfg.get('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(cfg.get('WEBAPP_PORT', 8443))
 
 # ----------------- LOGGING -----------------
 logging.basicConfig(level=logging.INFO)
@@ -60,65 +98,223 @@ storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
 
 # ----------------- DB UTIL -----------------
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute('''
+# One writer connection plus a pool of read-only connections (opened in init_db on startup).
+# In WAL mode readers never wait for the writer, so button presses are not blocked by registrations.
+READ_POOL_SIZE = max(os.cpu_count() or 1, 4)
+_write_conn = None
+_read_pool = None
+# serializes writers so a multi-statement transaction is never interleaved
+_write_lock = asyncio.Lock()
+
+# kept as a constant so the broadcast scan always hits sqlite's prepared statement cache.
+# Keyset-paged: a reader is held only per page, not for the whole broadcast, so the pool
+# stays available to button presses and WAL checkpoints are not blocked by a long snapshot.
+USER_IDS_PAGE = 1000
+_SQL_ALL_USERS = 'SELECT user_id FROM users WHERE inactive = 0 AND user_id > ? ORDER BY user_id LIMIT ?'
+# repeat /start keeps registered_at and only writes when the profile actually changed
+# (or the user comes back after having blocked the bot)
+_SQL_ADD_USER = '''
+    INSERT INTO users(user_id, username, first_name, last_name, registered_at) VALUES(?,?,?,?,?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        username = excluded.username,
+        first_name = excluded.first_name,
+        last_name = excluded.last_name,
+        inactive = 0
+    WHERE (users.username, users.first_name, users.last_name)
+        IS NOT (excluded.username, excluded.first_name, excluded.last_name)
+        OR users.inactive <> 0
+'''
+
+# settings are read on every purchase click but change only from the admin panel
+SETTINGS_TTL = 60  # seconds
+_settings_cache: Dict[str, Tuple[str, float]] = {}
+
+
+async def init_db():
+    global _write_conn, _read_pool
+    _write_conn = await aiosqlite.connect(DB_FILE, isolation_level=None)
+    # page_size only takes effect on a fresh database, before WAL is enabled
+    await _write_conn.executescript('''
+        PRAGMA page_size=8192;
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA busy_timeout=5000;
+        PRAGMA temp_store=memory;
+        PRAGMA cache_size=-20000;
+    ''')
+    await _write_conn.execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
             first_name TEXT,
             last_name TEXT,
-            registered_at TEXT
+            registered_at TEXT,
+            inactive INTEGER DEFAULT 0
         )
     ''')
-    cur.execute('''
+    # databases created before the inactive flag existed
+    async with _write_conn.execute('PRAGMA table_info(users)') as cur:
+        columns = [row[1] for row in await cur.fetchall()]
+    if 'inactive' not in columns:
+        await _write_conn.execute('ALTER TABLE users ADD COLUMN inactive INTEGER DEFAULT 0')
+    # partial index: the broadcast scan only walks users still reachable
+    await _write_conn.execute('CREATE INDEX IF NOT EXISTS ix_users_active ON users(inactive) WHERE inactive = 0')
+    await _write_conn.execute('''
         CREATE TABLE IF NOT EXISTS settings (
             key TEXT PRIMARY KEY,
             value TEXT
         )
     ''')
     # default card settings if missing
-    cur.execute("INSERT OR IGNORE INTO settings(key, value) VALUES(?,?)", ("card_number", "0000 0000 0000 0000"))
-    cur.execute("INSERT OR IGNORE INTO settings(key, value) VALUES(?,?)", ("recipient_fio", "Ф.И.О. Получателя"))
-    conn.commit()
-    conn.close()
-
-
-def db_set_setting(key: str, value: str):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute('REPLACE INTO settings(key, value) VALUES(?, ?)', (key, value))
-    conn.commit()
-    conn.close()
-
-
-def db_get_setting(key: str) -> str:
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute('SELECT value FROM settings WHERE key = ?', (key,))
-    row = cur.fetchone()
-    conn.close()
-    return row[0] if row else ''
-
-
-def db_add_user(user: types.User):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute('REPLACE INTO users(user_id, username, first_name, last_name, registered_at) VALUES(?,?,?,?,?)', (
-        user.id, user.username or '', user.first_name or '', user.last_name or '', datetime.utcnow().isoformat()
-    ))
-    conn.commit()
-    conn.close()
-
-
-def db_get_all_user_ids():
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute('SELECT user_id FROM users')
-    rows = cur.fetchall()
-    conn.close()
-    return [r[0] for r in rows]
+    await _write_conn.execute("INSERT OR IGNORE INTO settings(key, value) VALUES(?,?)", ("card_number", "0000 0000 0000 0000"))
+    await _write_conn.execute("INSERT OR IGNORE INTO settings(key, value) VALUES(?,?)", ("recipient_fio", "Ф.И.О. Получателя"))
+
+    # readers are opened after the schema exists and WAL is on
+    _read_pool = asyncio.Queue(maxsize=READ_POOL_SIZE)
+    for _ in range(READ_POOL_SIZE):
+        conn = await aiosqlite.connect(f'file:{DB_FILE}?mode=ro', uri=True)
+        await conn.executescript('''
+            PRAGMA busy_timeout=5000;
+            PRAGMA temp_store=memory;
+            PRAGMA cache_size=-20000;
+        ''')
+        _read_pool.put_nowait(conn)
+    # pre-warm the settings cache
+    await db_get_setting('card_number')
+    await db_get_setting('recipient_fio')
+
+
+async def close_db():
+    if _read_pool is not None:
+        while not _read_pool.empty():
+            await _read_pool.get_nowait().close()
+    if _write_conn is not None:
+        await _write_conn.close()
+
+
+@asynccontextmanager
+async def _reader():
+    conn = await _read_pool.get()
+    try:
+        yield conn
+    finally:
+        _read_pool.put_nowait(conn)
+
+
+async def db_set_settings(pairs: Dict[str, str]):
+    # one transaction (and one fsync) for all keys
+    async with _write_lock:
+        await _write_conn.execute('BEGIN IMMEDIATE')
+        try:
+            await _write_conn.executemany('REPLACE INTO settings(key, value) VALUES(?, ?)', pairs.items())
+        except Exception:
+            await _write_conn.rollback()
+            raise
+        await _write_conn.commit()
+
+
+def clear_settings_cache():
+    _settings_cache.clear()
+
+
+async def db_get_setting(key: str) -> str:
+    cached = _settings_cache.get(key)
+    if cached and time.monotonic() - cached[1] < SETTINGS_TTL:
+        return cached[0]
+    async with _reader() as conn:
+        async with conn.execute('SELECT value FROM settings WHERE key = ?', (key,)) as cur:
+            row = await cur.fetchone()
+    value = row[0] if row else ''
+    _settings_cache[key] = (value, time.monotonic())
+    return value
+
+
+async def db_add_user(user: types.User):
+    async with _write_lock:
+        await _write_conn.execute(_SQL_ADD_USER, (
+            user.id, user.username or '', user.first_name or '', user.last_name or '', datetime.utcnow().isoformat()
+        ))
+
+
+async def iter_user_ids() -> AsyncIterator[int]:
+    last_id = 0  # Telegram user ids are positive
+    while True:
+        async with _reader() as conn:
+            async with conn.execute(_SQL_ALL_USERS, (last_id, USER_IDS_PAGE)) as cur:
+                rows = await cur.fetchall()
+        for (uid,) in rows:
+            yield uid
+        if len(rows) < USER_IDS_PAGE:
+            return
+        last_id = rows[-1][0]
+
+
+async def db_mark_inactive(user_ids):
+    # chats that blocked the bot or were deleted, written in one transaction
+    async with _write_lock:
+        await _write_conn.execute('BEGIN IMMEDIATE')
+        try:
+            await _write_conn.executemany('UPDATE users SET inactive = 1 WHERE user_id = ?', ((uid,) for uid in user_ids))
+        except Exception:
+            await _write_conn.rollback()
+            raise
+        await _write_conn.commit()
+
+
+# Broadcast failures only queue the user id; a background task writes them in batches
+# so the number of transactions stays bounded however many sends fail.
+INACTIVE_FLUSH_INTERVAL = 2  # seconds
+INACTIVE_FLUSH_BATCH = 500  # flush early once this many ids are queued
+_pending_inactive: List[int] = []
+_flush_wakeup = None
+_flush_task = None
+
+
+def queue_inactive(uid: int):
+    _pending_inactive.append(uid)
+    if len(_pending_inactive) >= INACTIVE_FLUSH_BATCH and _flush_wakeup is not None:
+        _flush_wakeup.set()
+
+
+async def flush_inactive():
+    if not _pending_inactive:
+        return
+    batch = _pending_inactive[:]
+    _pending_inactive.clear()
+    try:
+        await db_mark_inactive(batch)
+    except Exception:
+        _pending_inactive.extend(batch)  # retried on the next flush
+        raise
+
+
+async def _inactive_flusher():
+    while True:
+        try:
+            await asyncio.wait_for(_flush_wakeup.wait(), INACTIVE_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _flush_wakeup.clear()
+        try:
+            await flush_inactive()
+        except Exception:
+            logger.exception('Failed to flush inactive users')
+
+
+def start_inactive_flusher():
+    global _flush_wakeup, _flush_task
+    _flush_wakeup = asyncio.Event()
+    _flush_task = asyncio.ensure_future(_inactive_flusher())
+
+
+async def stop_inactive_flusher():
+    if _flush_task is not None:
+        _flush_task.cancel()
+        try:
+            await _flush_task
+        except asyncio.CancelledError:
+            pass
+    await flush_inactive()
 
 # ----------------- PRODUCTS -----------------
 SUBJECTS = {
@@ -133,6 +329,29 @@ SUBJECTS = {
 }
 SCHOOLS = ['стобальный', 'пифагор']
 
+PROMO_TEXT = (
+    "🎓 Добро пожаловать в *ЕГЭ Школу Онлайн* — быстрые и понятные курсы для уверенной подготовки к экзаменам!\n\n"
+    "Здесь вы можете купить доступ к видеоурокам, авторским заданиям и разбору задач от опытных преподавателей.\n\n"
+    "📚 Доступна подготовка по профильной и базовой программе, персональные чек-листы и рекомендации.\n\n"
+    "Выберите предмет и программу — получите готовую дорожную карту подготовки и материалы сразу после оплаты.")
+
+# product-detail message: everything except the card/FIO line is known up front
+PRODUCT_PREFIX = {
+    (key, school): f"*Товар:* {title} — {school}\n*Цена:* {price}₽\n\n*Реквизиты для оплаты:*\n"
+    for key, (title, price) in SUBJECTS.items() for school in SCHOOLS
+}
+PRODUCT_SUFFIX = (
+    f"\n\nПосле оплаты пришлите, пожалуйста, чек менеджеру @{MANAGER_USERNAME}.\n"
+    "Мы пришлем доступ в течение рабочего времени."
+)
+
+# every subject/school callback_data the keyboards can produce, mapped to its parsed form
+CALLBACK_ACTIONS = {f'subj|{key}': ('subj', key) for key in SUBJECTS}
+CALLBACK_ACTIONS.update({
+    f'school|{key}|{school}': ('school', key, school)
+    for key in SUBJECTS for school in SCHOOLS
+})
+
 # ----------------- FSM -----------------
 class AdminStates(StatesGroup):
     waiting_broadcast_text = State()
@@ -174,67 +393,166 @@ def make_admin_keyboard():
     kb.add(InlineKeyboardButton('💳 Указать номер карты', callback_data='admin_set_card'))
     return kb
 
+
+def make_product_keyboard():
+    kb = InlineKeyboardMarkup(row_width=1)
+    kb.add(InlineKeyboardButton('Связаться с менеджером', url=f'https://t.me/{MANAGER_USERNAME}'))
+    kb.add(InlineKeyboardButton('⬅️ Назад к предметам', callback_data='back_subjects'))
+    return kb
+
+
+# keyboards depend only on constants, so build them once
+START_KB = make_start_keyboard()
+SUBJECTS_KB = make_subjects_keyboard()
+SCHOOLS_KB = {k: make_schools_keyboard(k) for k in SUBJECTS}
+ADMIN_KB = make_admin_keyboard()
+PRODUCT_KB = make_product_keyboard()
+
+# chat_id -> (message_id, screen) last shown, so bouncing between screens
+# doesn't send edits Telegram would reject as "message is not modified".
+# LRU-bounded: only recently active chats matter for dedup.
+LAST_SCREEN_MAX = 10000
+_last_screen: 'OrderedDict[int, Tuple[int, str]]' = OrderedDict()
+
+
+def remember_screen(chat_id: int, message_id: int, screen: str):
+    _last_screen[chat_id] = (message_id, screen)
+    _last_screen.move_to_end(chat_id)
+    if len(_last_screen) > LAST_SCREEN_MAX:
+        _last_screen.popitem(last=False)
+
+
+async def edit_screen(cb: types.CallbackQuery, screen: str, **kwargs):
+    chat_id = cb.message.chat.id
+    message_id = cb.message.message_id
+    if _last_screen.get(chat_id) == (message_id, screen):
+        return
+    try:
+        await bot.edit_message_text(chat_id=chat_id, message_id=message_id, **kwargs)
+    except MessageNotModified:
+        pass
+    remember_screen(chat_id, message_id, screen)
+
+# ----------------- BROADCAST -----------------
+# Telegram allows ~30 messages per second bot-wide
+BROADCAST_CONCURRENCY = 30
+BROADCAST_MAX_RETRIES = 3  # attempts on network errors; FloodWait waits don't count
+BROADCAST_ERROR_SAMPLE = 20  # failures kept for the summary log
+broadcast_limiter = AsyncLimiter(30, 1)
+# FloodWait is bot-wide: every sender holds off until this monotonic time
+_flood_resume_at = 0.0
+
+
+def _pause_for_flood(seconds: float):
+    global _flood_resume_at
+    _flood_resume_at = max(_flood_resume_at, time.monotonic() + seconds)
+
+
+async def _wait_for_flood():
+    # loop: the pause may be extended by another sender while we sleep
+    while True:
+        delay = _flood_resume_at - time.monotonic()
+        if delay <= 0:
+            return
+        await asyncio.sleep(delay)
+
+
+async def broadcast_message(text: str, user_ids: AsyncIterator[int]) -> Tuple[int, int]:
+    """Send text to every user id as they are streamed in, returns (sent, failed)."""
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    sent = 0
+    failed = 0
+    first_errs = []
+
+    async def send_one(uid: int):
+        nonlocal sent, failed
+        try:
+            attempt = 0
+            while True:
+                await _wait_for_flood()
+                try:
+                    async with broadcast_limiter:
+                        await bot.send_message(uid, text)
+                    sent += 1
+                    return
+                except RetryAfter as e:
+                    # flood control: Telegram tells us exactly how long to wait;
+                    # pause all senders and resend without using up an attempt
+                    _pause_for_flood(e.timeout)
+                except NetworkError:
+                    attempt += 1
+                    if attempt >= BROADCAST_MAX_RETRIES:
+                        raise
+                    await asyncio.sleep(2 ** (attempt - 1))
+        except (Unauthorized, ChatNotFound) as e:
+            # dead chat: no point retrying, remember it to skip in the future
+            failed += 1
+            queue_inactive(uid)
+            if len(first_errs) < BROADCAST_ERROR_SAMPLE:
+                first_errs.append((uid, type(e).__name__))
+        except TelegramAPIError as e:
+            # other expected API errors: count it, no traceback per user
+            failed += 1
+            if len(first_errs) < BROADCAST_ERROR_SAMPLE:
+                first_errs.append((uid, type(e).__name__))
+        except Exception as e:
+            logger.exception(f'Failed to send to {uid}: {e}')
+            failed += 1
+        finally:
+            sem.release()
+
+    # the semaphore is acquired before spawning, so at most BROADCAST_CONCURRENCY sends are in flight
+    tasks = set()
+    async for uid in user_ids:
+        await sem.acquire()
+        task = asyncio.ensure_future(send_one(uid))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+    if failed:
+        logger.warning(f'Broadcast: sent {sent}, failed {failed}; sample: {first_errs}')
+    return sent, failed
+
 # ----------------- HANDLERS -----------------
 @dp.message_handler(commands=['start'])
 async def cmd_start(message: types.Message):
     # register user
-    db_add_user(message.from_user)
-    text = (
-        "🎓 Добро пожаловать в *ЕГЭ Школу Онлайн* — быстрые и понятные курсы для уверенной подготовки к экзаменам!\n\n"
-        "Здесь вы можете купить доступ к видеоурокам, авторским заданиям и разбору задач от опытных преподавателей.\n\n"
-        "📚 Доступна подготовка по профильной и базовой программе, персональные чек-листы и рекомендации.\n\n"
-        "Выберите предмет и программу — получите готовую дорожную карту подготовки и материалы сразу после оплаты.")
-    await message.answer(text, reply_markup=make_start_keyboard(), parse_mode='Markdown')
-
-@dp.callback_query_handler(lambda c: c.data == 'buy')
+    await db_add_user(message.from_user)
+    sent = await message.answer(PROMO_TEXT, reply_markup=START_KB, parse_mode='Markdown')
+    remember_screen(sent.chat.id, sent.message_id, 'start')
+
 async def process_buy(cb: types.CallbackQuery):
     await cb.answer()
-    await bot.edit_message_text(chat_id=cb.message.chat.id, message_id=cb.message.message_id,
-                                text='Выберите предмет:', reply_markup=make_subjects_keyboard())
+    await edit_screen(cb, 'subjects', text='Выберите предмет:', reply_markup=SUBJECTS_KB)
 
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith('subj|'))
 async def process_subject(cb: types.CallbackQuery):
     await cb.answer()
-    _, subj_key = cb.data.split('|', 1)
-    await bot.edit_message_text(chat_id=cb.message.chat.id, message_id=cb.message.message_id,
-                                text=f"Предмет: *{SUBJECTS[subj_key][0]}*\nВыберите программу:", reply_markup=make_schools_keyboard(subj_key), parse_mode='Markdown')
+    action = CALLBACK_ACTIONS.get(cb.data)
+    if action is None:
+        return  # stale button from an older keyboard
+    _, subj_key = action
+    await edit_screen(cb, cb.data, text=f"Предмет: *{SUBJECTS[subj_key][0]}*\nВыберите программу:",
+                      reply_markup=SCHOOLS_KB[subj_key], parse_mode='Markdown')
 
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith('school|'))
 async def process_school(cb: types.CallbackQuery):
     await cb.answer()
-    _, subj_key, school = cb.data.split('|', 2)
-    subj_title, price = SUBJECTS[subj_key]
+    action = CALLBACK_ACTIONS.get(cb.data)
+    if action is None:
+        return  # stale button from an older keyboard
+    _, subj_key, school = action
     # fetch card info
-    card = db_get_setting('card_number')
-    fio = db_get_setting('recipient_fio')
-    text = (
-        f"*Товар:* {subj_title} — {school}\n"
-        f"*Цена:* {price}₽\n\n"
-        f"*Реквизиты для оплаты:*\n{card}\n{fio}\n\n"
-        f"После оплаты пришлите, пожалуйста, чек менеджеру @{MANAGER_USERNAME}.\n"
-        "Мы пришлем доступ в течение рабочего времени."
-    )
-    kb = InlineKeyboardMarkup(row_width=1)
-    kb.add(InlineKeyboardButton('Связаться с менеджером', url=f'https://t.me/{MANAGER_USERNAME}'))
-    kb.add(InlineKeyboardButton('⬅️ Назад к предметам', callback_data='back_subjects'))
-    await bot.edit_message_text(chat_id=cb.message.chat.id, message_id=cb.message.message_id,
-                                text=text, parse_mode='Markdown', reply_markup=kb)
+    card = await db_get_setting('card_number')
+    fio = await db_get_setting('recipient_fio')
+    text = PRODUCT_PREFIX[(subj_key, school)] + card + '\n' + fio + PRODUCT_SUFFIX
+    await edit_screen(cb, cb.data, text=text, parse_mode='Markdown', reply_markup=PRODUCT_KB)
 
-@dp.callback_query_handler(lambda c: c.data == 'back_subjects')
 async def back_subjects(cb: types.CallbackQuery):
     await cb.answer()
-    await bot.edit_message_text(chat_id=cb.message.chat.id, message_id=cb.message.message_id,
-                                text='Выберите предмет:', reply_markup=make_subjects_keyboard())
+    await edit_screen(cb, 'subjects', text='Выберите предмет:', reply_markup=SUBJECTS_KB)
 
-@dp.callback_query_handler(lambda c: c.data == 'back_start')
 async def back_start(cb: types.CallbackQuery):
     await cb.answer()
-    text = (
-        "🎓 Добро пожаловать в *ЕГЭ Школу Онлайн* — быстрые и понятные курсы для уверенной подготовки к экзаменам!\n\n"
-        "Здесь вы можете купить доступ к видеоурокам..."
-    )
-    await bot.edit_message_text(chat_id=cb.message.chat.id, message_id=cb.message.message_id,
-                                text=text, reply_markup=make_start_keyboard(), parse_mode='Markdown')
+    await edit_screen(cb, 'start', text=PROMO_TEXT, reply_markup=START_KB, parse_mode='Markdown')
 
 # ----------------- ADMIN -----------------
 @dp.message_handler(commands=['admin'])
@@ -242,9 +560,8 @@ async def cmd_admin(message: types.Message):
     if message.from_user.id != ADMIN_ID:
         await message.reply('Доступ запрещён.')
         return
-    await message.reply('Панель администратора:', reply_markup=make_admin_keyboard())
+    await message.reply('Панель администратора:', reply_markup=ADMIN_KB)
 
-@dp.callback_query_handler(lambda c: c.data == 'admin_broadcast')
 async def admin_broadcast(cb: types.CallbackQuery):
     if cb.from_user.id != ADMIN_ID:
         await cb.answer('Нет доступа', show_alert=True)
@@ -266,7 +583,7 @@ async def receive_broadcast_text(message: types.Message, state: FSMContext):
     await message.reply('Предпросмотр рассылки:\n\n' + text, reply_markup=kb)
     await AdminStates.waiting_broadcast_confirm.set()
 
-@dp.callback_query_handler(lambda c: c.data in ('broadcast_cancel', 'broadcast_confirm'), state=AdminStates.waiting_broadcast_confirm)
+@dp.callback_query_handler(Text(equals=['broadcast_cancel', 'broadcast_confirm']), state=AdminStates.waiting_broadcast_confirm)
 async def broadcast_confirm_or_cancel(cb: types.CallbackQuery, state: FSMContext):
     if cb.from_user.id != ADMIN_ID:
         await cb.answer('Нет доступа', show_alert=True)
@@ -280,22 +597,10 @@ async def broadcast_confirm_or_cancel(cb: types.CallbackQuery, state: FSMContext
     data = await state.get_data()
     text = data.get('broadcast_text', '')
     await cb.answer('Запуск рассылки...')
-    user_ids = db_get_all_user_ids()
-    sent = 0
-    failed = 0
-    for uid in user_ids:
-        try:
-            await bot.send_message(uid, text)
-            sent += 1
-            await asyncio.sleep(0.05)  # small delay to be polite
-        except Exception as e:
-            logger.exception(f'Failed to send to {uid}: {e}')
-            failed += 1
-            await asyncio.sleep(0.05)
+    sent, failed = await broadcast_message(text, iter_user_ids())
     await bot.send_message(ADMIN_ID, f'Готово. Отправлено: {sent}. Не доставлено: {failed}.')
     await state.finish()
 
-@dp.callback_query_handler(lambda c: c.data == 'admin_set_card')
 async def admin_set_card(cb: types.CallbackQuery):
     if cb.from_user.id != ADMIN_ID:
         await cb.answer('Нет доступа', show_alert=True)
@@ -322,21 +627,83 @@ async def receive_recipient_fio(message: types.Message, state: FSMContext):
     fio = message.text.strip()
     data = await state.get_data()
     card = data.get('card_number', '')
-    db_set_setting('card_number', card)
-    db_set_setting('recipient_fio', fio)
+    await db_set_settings({'card_number': card, 'recipient_fio': fio})
+    clear_settings_cache()
+    _last_screen.clear()  # product screens show the old requisites
     await message.reply(f'Реквизиты обновлены:\n{card}\n{fio}')
     await state.finish()
 
+# ----------------- CALLBACK DISPATCH -----------------
+# one handler for all stateless buttons: the callback_data prefix (up to '|')
+# picks the coroutine with a single dict lookup instead of running a filter per handler
+CB_DISPATCH = {
+    'buy': process_buy,
+    'subj': process_subject,
+    'school': process_school,
+    'back_subjects': back_subjects,
+    'back_start': back_start,
+    'admin_broadcast': admin_broadcast,
+    'admin_set_card': admin_set_card,
+}
+
+
+@dp.callback_query_handler()
+async def dispatch_callback(cb: types.CallbackQuery):
+    handler = CB_DISPATCH.get(cb.data.partition('|')[0]) if cb.data else None
+    if handler is None:
+        await cb.answer()
+        return
+    await handler(cb)
+
 # ----------------- SAFETY / MISC -----------------
-@dp.message_handler(content_types=types.ContentTypes.ANY)
+# polite fallback for unknown text; unknown /commands and non-text updates
+# match no handler and are dropped by the dispatcher without entering Python code here
+@dp.message_handler(content_types=types.ContentTypes.TEXT, regexp=r'^[^/]')
 async def catch_all(message: types.Message):
-    # polite fallback for unknown messages
-    if message.text and message.text.startswith('/'):
-        return  # unknown commands ignored
     await message.reply('Команда не распознана. Нажмите /start чтобы вернуться в начало.')
 
 # ----------------- START -----------------
+async def on_startup(dispatcher: Dispatcher):
+    await init_db()
+    start_inactive_flusher()
+    if WEBHOOK_HOST:
+        # Telegram drops the backlog itself, nothing is fetched just to be skipped
+        await bot.set_webhook(WEBHOOK_URL, drop_pending_updates=True, secret_token=WEBHOOK_SECRET)
+
+
+async def on_shutdown(dispatcher: Dispatcher):
+    if WEBHOOK_HOST:
+        await bot.delete_webhook()
+    await stop_inactive_flusher()
+    await close_db()
+
+
+@web.middleware
+async def check_webhook_secret(request: web.Request, handler):
+    # aiogram 2 does not verify the secret token itself; without it anyone
+    # reaching the port could post forged updates (e.g. as the admin)
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+        return web.Response(status=403)
+    return await handler(request)
+
+
+def make_ssl_context():
+    if not WEBHOOK_SSL_CERT:
+        return None  # TLS is terminated by a reverse proxy
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(WEBHOOK_SSL_CERT, WEBHOOK_SSL_PRIV)
+    return context
+
+
 if __name__ == '__main__':
-    init_db()
     print('Bot is starting...')
-    executor.start_polling(dp, skip_updates=True)
+    if WEBHOOK_HOST:
+        # start_webhook() has no web_app argument, so build the executor to install the middleware.
+        # Behind a proxy the peer is the proxy itself, so the IP check only applies to direct HTTPS.
+        webhook = executor.set_webhook(dispatcher=dp, webhook_path=WEBHOOK_PATH, on_startup=on_startup,
+                                       on_shutdown=on_shutdown, check_ip=bool(WEBHOOK_SSL_CERT),
+                                       web_app=web.Application(middlewares=[check_webhook_secret]))
+        webhook.run_app(host=WEBAPP_HOST, port=WEBAPP_PORT, ssl_context=make_ssl_context())
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)